@@ -3,19 +3,31 @@ import requests
 import cachecontrol
 from flask import Flask, request
 from flask_cors import CORS
-import copy
-from secret import CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN
-import boto3
+from secret import CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN, API_KEY
 import os
+import random
 import json
 import datetime
+import functools
 import gzip
+import hashlib
+import hmac
+import io
+import orjson
 import logging
 import sys
+import tempfile
+import threading
 import time
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 
 ACCESS_TOKEN_KEY = 'access-token.json'
+ETAGS_KEY = 'state/etags.json'
+LAST_DIGEST_KEY = 'state/last-digest.txt'
 
 SCOPES = 'playlist-read-private playlist-read-collaborative playlist-modify-public playlist-modify-private streaming user-follow-modify user-follow-read user-library-read user-library-modify user-read-private user-read-birthdate user-read-email user-top-read user-read-recently-played user-read-playback-state'
 
@@ -23,35 +35,198 @@ URLS = {
     'token': 'https://accounts.spotify.com/api/token',
     'recently_played': 'https://api.spotify.com/v1/me/player/recently-played',
     'list_playlists': 'https://api.spotify.com/v1/me/playlists',
-    'playlist': 'https://api.spotify.com/v1/users/{user_id}/playlists/{playlist_id}',
     'me': 'https://api.spotify.com/v1/me',
     'devices': 'https://api.spotify.com/v1/me/player/devices',
-    'top': 'https://api.spotify.com/v1/me/top/{type}',
     'followed_artists': 'https://api.spotify.com/v1/me/following?type=artist',
     'saved_albums': 'https://api.spotify.com/v1/me/albums',
     'saved_tracks': 'https://api.spotify.com/v1/me/tracks',
-    'current_track': 'https://api.spotify.com/v1/me/player/currently-playing',
-    'add_track': 'https://api.spotify.com/v1/playlists/{playlist_id}/tracks',
-    'remove_track': 'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
+    'current_track': 'https://api.spotify.com/v1/me/player/currently-playing'
 }
 
 
+# urls with parameters in them
+def url_playlist(user_id, playlist_id):
+    return f'https://api.spotify.com/v1/users/{user_id}/playlists/{playlist_id}'
+
+
+def url_top(type_):
+    return f'https://api.spotify.com/v1/me/top/{type_}'
+
+
+def url_playlist_tracks(playlist_id):
+    return f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
+
+
+
 LOG = logging.getLogger('spotifyapi')
 
+# api keys are compared by digest so the comparison is constant time
+API_KEY_HASH = hashlib.sha256(API_KEY.encode('utf-8')).digest()
+
+# how many requests may be in flight against the api at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# retrying of failed requests, delays are in seconds
+MAX_RETRIES = 8
+BACKOFF_BASE = 1
+BACKOFF_CAP = 30
+BACKOFF_JITTER = 0.5
+
+# Spotify rate limits over a rolling 30 second window, stay below it
+RATE_LIMIT_WINDOW = 30
+RATE_LIMIT_REQUESTS = 150
+
+# concurrency is cut by AIMD_DECREASE when the rate limit comes close and
+# grows back by AIMD_INCREASE per successful request
+RATE_LIMIT_LOW_WATER = 0.1
+AIMD_DECREASE = 0.5
+AIMD_INCREASE = 0.5
+
+# connections kept alive per host, enough for every concurrent request
+POOL_MAXSIZE = 50
+
+# seconds the list of playlists used by move_current_song is reused for
+PLAYLIST_INDEX_TTL = 60
+
+# access tokens are refreshed this many seconds before Spotify expires them
+TOKEN_EXPIRY_MARGIN = 300
+
+# uploads to s3 above this many bytes are split into concurrently sent parts
+UPLOAD_MULTIPART_THRESHOLD = 5 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 8
+
+# the most tracks Spotify accepts in one add or remove request
+MAX_TRACKS_PER_REQUEST = 100
+
+
+def _parse(response):
+    """parses a response's json body with orjson, much faster than r.json()
+
+    :returns: the parsed body, None for an empty one such as a 204's
+    :rtype: dict or list
+
+    """
+    if not response.content:
+        return None
+    return orjson.loads(response.content)
+
+
+def _token_path():
+    return os.path.join(tempfile.gettempdir(), ACCESS_TOKEN_KEY)
+
+
+def _load_token():
+    """reads the access token cached by an earlier Puller in this container
+
+    :returns: tuple of the token and when to refresh it, None if there is no
+        cached token or it is about to expire
+    :rtype: tuple
+
+    """
+    try:
+        with open(_token_path(), 'rb') as f:
+            j = orjson.loads(f.read())
+        token, expires = j['token'], j['expires']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if time.time() >= expires:
+        return None
+    return token, expires
+
+
+def _save_token(token, expires):
+    """caches the access token in /tmp, which outlives warm Lambda invocations"""
+    fd = os.open(_token_path(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'wb') as f:
+        f.write(orjson.dumps({'token': token, 'expires': expires}))
+
+
+class _ConcurrencyLimiter:
+    """A semaphore whose limit can be lowered and raised while in use"""
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def decrease(self):
+        with self._cond:
+            self.limit = max(1.0, self.limit * AIMD_DECREASE)
+
+    def increase(self):
+        with self._cond:
+            self.limit = min(self.max_limit, self.limit + AIMD_INCREASE)
+            self._cond.notify_all()
+
+
+def _build_session():
+    """builds a caching session with a connection pool sized for concurrency
+
+    The adapter is mounted directly rather than through
+    cachecontrol.CacheControl, which would replace it with a default sized one.
+
+    requests only speaks HTTP/1.1, so every concurrent request holds its own
+    keep-alive connection. POOL_MAXSIZE must stay at least
+    MAX_CONCURRENT_REQUESTS, otherwise connections are closed after each
+    burst and the next one pays for new TLS handshakes.
+
+    """
+    sess = requests.Session()
+    adapter = cachecontrol.CacheControlAdapter(pool_maxsize=POOL_MAXSIZE)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return sess
+
+
+# shared by every Puller so warm invocations reuse open connections and cache
+_SESSION = _build_session()
+
 
 class Puller:
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, etags=None, last_dump=None):
         self.verbose=verbose
+        # url -> ETag, None disables conditional requests
+        self.etags = etags
+        # key of the dump the bodies for those ETags are read from
+        self.last_dump = last_dump
+        self._dump = None
+        self._dump_lock = threading.Lock()
+        # the ETags used by this Puller, saving these drops stale urls
+        self.new_etags = {}
         if verbose:
             LOG.setLevel(logging.DEBUG)
-        self.sess = cachecontrol.CacheControl(requests.Session())
+        self.sess = _SESSION
+        self._slots = _ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS)
+        self._timestamps = deque()
+        self._timestamps_lock = threading.Lock()
         self.auth = (CLIENT_ID, CLIENT_SECRET)
-        self.access_token = self._refresh_token()
-        self.auth_headers = {"Authorization": "Bearer " + self.access_token}
+        self._token_lock = threading.Lock()
+        cached = _load_token()
+        if cached:
+            self.access_token, self.token_expires = cached
+        else:
+            self.access_token = self._refresh_token()
+
+    @property
+    def auth_headers(self):
+        return {"Authorization": "Bearer " + self.access_token}
 
-    def _log(self, msg):
+    def _log(self, msg, *args):
+        """logs msg % args, the formatting is skipped when nothing is logged"""
         if self.verbose:
-            LOG.info(msg)
+            LOG.info(msg, *args)
 
     def _refresh_token(self):
         data = {
@@ -60,35 +235,114 @@ class Puller:
         }
         r = self.sess.post(URLS['token'], auth=self.auth, data=data)
         # self._log('refreshing token')
-        token = r.json()['access_token']
-        self._log('new token: {}'.format(token))
+        j = _parse(r)
+        token = j['access_token']
+        self.token_expires = (time.time() + j.get('expires_in', 3600)
+                              - TOKEN_EXPIRY_MARGIN)
+        self._log('new token: %s', token)
+        try:
+            _save_token(token, self.token_expires)
+        except OSError as e:
+            LOG.warning('could not cache access token: %s', e)
         return token
 
-    def _rate_limit_check(self, response):
-        """Checks the response header, if necessary waits what Spotify requires
+    def _ensure_token(self, rejected=None):
+        """Refreshes the access token if it is about to expire or was rejected
+
+        :param rejected: an access token Spotify answered 401 to, it is only
+            refreshed if no other thread has done so already
+
+        """
+        with self._token_lock:
+            if (time.time() >= self.token_expires or
+                    self.access_token == rejected):
+                self.access_token = self._refresh_token()
+
+    def wait_if_throttled(self):
+        """Blocks until another request fits into the rate limit window"""
+        with self._timestamps_lock:
+            while True:
+                now = time.monotonic()
+                while (self._timestamps and
+                       self._timestamps[0] <= now - RATE_LIMIT_WINDOW):
+                    self._timestamps.popleft()
+                if len(self._timestamps) < RATE_LIMIT_REQUESTS:
+                    self._timestamps.append(now)
+                    return
+                wait = self._timestamps[0] + RATE_LIMIT_WINDOW - now
+                self._log('throttling for %.1f seconds', wait)
+                time.sleep(wait)
+
+    def _adjust_concurrency(self, response):
+        """Backs off concurrency when Spotify's rate limit is running out
 
         :param response: the requests response object
-        :returns: True if the request needs to be resent
-        :rtype: bool
 
         """
-        code = response.status_code
-        if code == 429:
-            t = r.header.get('Retry-After')
-            self._log('Received Retry-After {} Seconds Header'.format(t))
-            time.sleep(int(t))
-            return True
-        elif code in [200, 201]:
-            return False
-        elif code in [400, 403]:
-            LOG.error('returned status code {}'.format(code))
-            print(response.text)
-            exit()
-        else:
-            LOG.warning('returned status code {}, trying again in 5 seconds'
-                    .format(code))
-            time.sleep(5)
-            return True
+        limit = response.headers.get('X-RateLimit-Limit')
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if response.status_code == 429:
+            self._slots.decrease()
+        elif (limit and remaining and
+                int(remaining) < RATE_LIMIT_LOW_WATER * int(limit)):
+            self._slots.decrease()
+        elif 200 <= response.status_code < 300:
+            self._slots.increase()
+
+    def _request(self, method, url, **kwargs):
+        """Sends a request, retrying with exponential backoff when it fails
+
+        A 429 waits for as long as Spotify's Retry-After header asks and a 5xx
+        waits base * 2**attempt seconds (capped) plus some jitter. The first
+        401 refreshes the access token and retries at once. Any other 4xx is
+        permanent and raised straight away.
+
+        :param method: the http method, e.g. 'GET'
+        :param url: the url to request
+        :param kwargs: passed on to the session, headers are merged with the
+            authorization headers
+        :returns: the requests response object
+        :rtype: requests.Response
+        :raises requests.HTTPError: on a 4xx other than 429, a second 401, or
+            once retries run out
+
+        """
+        extra_headers = kwargs.pop('headers', None) or {}
+        refreshed = False
+        for attempt in range(MAX_RETRIES):
+            self._ensure_token()
+            token = self.access_token
+            headers = dict(self.auth_headers)
+            headers.update(extra_headers)
+            self.wait_if_throttled()
+            with self._slots:
+                r = self.sess.request(method, url, headers=headers, **kwargs)
+            self._adjust_concurrency(r)
+            code = r.status_code
+            if 200 <= code < 300 or code == 304:
+                return r
+            elif code == 401 and not refreshed:
+                self._log('access token rejected, refreshing')
+                self._ensure_token(rejected=token)
+                refreshed = True
+                continue
+            elif code != 429 and code < 500:
+                LOG.error('returned status code %s: %s', code, r.text)
+                r.raise_for_status()
+            if attempt == MAX_RETRIES - 1:
+                break
+            backoff = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+            if code == 429:
+                delay = int(r.headers.get('Retry-After', backoff))
+                self._log('Received Retry-After %s Seconds Header', delay)
+                delay += random.uniform(0, BACKOFF_JITTER)
+            else:
+                delay = backoff * (1 + random.uniform(0, BACKOFF_JITTER))
+                LOG.warning('returned status code %s, trying again in %.1f '
+                            'seconds', code, delay)
+            time.sleep(delay)
+        r.raise_for_status()
+        return r
 
     def get_top(self, type_, time_range):
         """gets the top artist or tracks
@@ -103,61 +357,132 @@ class Puller:
             "limit": 50,
             "time_range": time_range
         }
-        url = URLS['top'].format(type=type_)
-        self._log('fetching {} ({})'.format(url, time_range))
-        r = self.sess.get(url, params=payload, headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self.get_tops(type_, time_range)
-        return r.json()
+        url = url_top(type_)
+        self._log('fetching %s (%s)', url, time_range)
+        return _parse(self._request('GET', url, params=payload))
 
     def get_devices(self):
         self._log('fetching devices')
-        r = self.sess.get(URLS['devices'], headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self.get_devices()
-        return r.json()
+        return _parse(self._request('GET', URLS['devices']))
+
+    def _get_page(self, url):
+        return _parse(self._request('GET', url))
+
+    def _page_urls(self, first_page):
+        """builds the urls of all pages following first_page
+
+        :param first_page: dict with keys 'href', 'offset', 'limit' and 'total'
+        :returns: list of urls, in order
+        :rtype: list
+
+        """
+        scheme, netloc, path, query, fragment = urlsplit(first_page['href'])
+        query = dict(parse_qsl(query))
+        limit = first_page['limit']
+        urls = []
+        for offset in range(first_page['offset'] + limit,
+                            first_page['total'], limit):
+            query.update(offset=offset, limit=limit)
+            urls.append(urlunsplit(
+                (scheme, netloc, path, urlencode(query), fragment)))
+        return urls
 
     def _iterate_paging_object(self, first_page):
         """returns all items in a paging object
 
+        Offset based paging objects have all of their remaining pages fetched
+        concurrently, cursor based ones are walked one page at a time.
+
         :param first_page: dict with keys 'items' and 'next'
         :returns: list of items, starting with those in first_page
         :rtype: list
 
         """
         page = first_page
-        items = page['items']
-        while page['next']:
-            self._log('paging')
-            while True:
-                r = self.sess.get(page['next'], headers=self.auth_headers)
-                if self._rate_limit_check(r):
-                    continue
-                break
-            page = r.json()
-            items += page['items']
+        # copied so that first_page['items'] is left untouched
+        items = list(page['items'])
+        if not page['next']:
+            return items
+        if 'offset' not in page or page.get('total') is None:
+            while page['next']:
+                self._log('paging')
+                page = self._get_page(page['next'])
+                items.extend(page['items'])
+            return items
+        urls = self._page_urls(first_page)
+        self._log('paging (%d pages)', len(urls))
+        with ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS) as pool:
+            pages = list(pool.map(self._get_page, urls))
+        items.extend(chain.from_iterable(p['items'] for p in pages))
         return items
 
+    def _previous_body(self, location):
+        """finds a body in the dump of the previous pull, loading it once
+
+        :param location: ('saved_albums',) for a top level key of the dump, or
+            ('playlists', playlist_id) for a single playlist
+        :returns: the body, None if the dump does not have it
+        :rtype: dict
+
+        """
+        with self._dump_lock:
+            if self._dump is None:
+                dump = load_dump(self.last_dump) if self.last_dump else None
+                self._dump = dump or {}
+        section = self._dump.get(location[0])
+        if len(location) == 1:
+            return section
+        return next((x for x in section or [] if x.get('id') == location[1]),
+                    None)
+
+    def _conditional_get(self, url, location, params=None):
+        """GETs url, sending the ETag of the last response it returned
+
+        If Spotify answers 304 Not Modified the body is taken from the previous
+        dump instead, see _previous_body.
+
+        :param url: the url to request
+        :param location: where the body sits in a dump, see _previous_body
+        :param params: query parameters
+        :returns: the json body and whether it was freshly fetched
+        :rtype: tuple
+
+        """
+        if self.etags is None:
+            return _parse(self._request('GET', url, params=params)), True
+        key = requests.Request('GET', url, params=params).prepare().url
+        etag = self.etags.get(key)
+        headers = {'If-None-Match': etag} if etag else None
+        r = self._request('GET', url, params=params, headers=headers)
+        if r.status_code == 304:
+            body = self._previous_body(location)
+            if body is not None:
+                self._log('not modified %s', url)
+                self.new_etags[key] = etag
+                return body, False
+            self._log('%s is not in the last dump, refetching', url)
+            r = self._request('GET', url, params=params)
+        etag = r.headers.get('ETag')
+        if etag:
+            self.new_etags[key] = etag
+        return _parse(r), True
+
     def _get_a_playlist(self, user_id, playlist_id):
-        url = URLS['playlist'].format(user_id=user_id, playlist_id=playlist_id)
-        self._log('fetching playlist {}'.format(url))
-        r = self.sess.get(url, headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self._get_a_playlist(user_id, playlist_id)
-        j = r.json()
-        tracks = self._iterate_paging_object(j['tracks'])
-        j['tracks'] = tracks
+        url = url_playlist(user_id, playlist_id)
+        self._log('fetching playlist %s', url)
+        j, modified = self._conditional_get(url, ('playlists', playlist_id))
+        # an unmodified playlist comes from the dump, tracks already unwrapped
+        if modified:
+            tracks = self._iterate_paging_object(j['tracks'])
+            j['tracks'] = tracks
         return j
 
     def get_playlists_short(self):
         """gets a user's list of playlists but not their tracks"""
         payload = {'limit': 50}
         self._log('fetching list of playlists')
-        r = self.sess.get(URLS['list_playlists'],
-                          params=payload, headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self.get_playlists()
-        j = r.json()
+        r = self._request('GET', URLS['list_playlists'], params=payload)
+        j = _parse(r)
         return list(self._iterate_paging_object(j))
 
     def get_playlists(self):
@@ -172,74 +497,223 @@ class Puller:
         :rtype: list
 
         """
-        def get_full_playlist(playlist): 
-            return self._get_a_playlist(playlist['owner']['id'],playlist['id'])
+        def get_full_playlist(playlist):
+            return self._get_a_playlist(playlist['owner']['id'], playlist['id'])
+
+        playlists = self.get_playlists_short()
+        with ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS) as pool:
+            return list(pool.map(get_full_playlist, playlists))
 
-        return [get_full_playlist(p) for p in self.get_playlists_short()]
+    def _get_simple_endpoint(self, url, dump_key):
+        """fetches the first page of url
+
+        :param dump_key: the key pull() stores the response under
+        :returns: json response
+        :rtype: dict
 
-    def _get_simple_endpoint(self, url):
-        self._log('fetching {}'.format(url))
+        """
+        self._log('fetching %s', url)
         payload = {"limit": 50}
-        r = self.sess.get(url, params=payload, headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self._get_simple_endpoint(url)
-        return (r.json())
+        return self._conditional_get(url, (dump_key,), params=payload)[0]
 
     def get_recently_played(self):
         url = URLS['recently_played']
-        self._get_simple_endpoint(url)
+        return self._get_simple_endpoint(url, 'recently_played')
 
     def get_followed_artists(self):
-        self._get_simple_endpoint(URLS['followed_artists'])
+        return self._get_simple_endpoint(URLS['followed_artists'],
+                                         'followed_artists')
 
     def get_saved_albums(self):
-        self._get_simple_endpoint(URLS['saved_albums'])
+        return self._get_simple_endpoint(URLS['saved_albums'], 'saved_albums')
 
     def get_saved_tracks(self):
-        self._get_simple_endpoint(URLS['saved_tracks'])
+        return self._get_simple_endpoint(URLS['saved_tracks'], 'saved_tracks')
 
     def get_current_track(self):
         url = URLS['current_track']
-        self._log('fetching {}'.format(url))
-        r = self.sess.get(url, params=None, headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self.get_current_track()
-        return r.json()
+        self._log('fetching %s', url)
+        return _parse(self._request('GET', url))
+
+    def remove_tracks(self, playlist_id, track_uris):
+        """removes tracks from a playlist, up to 100 per request
+
+        :param playlist_id: the playlist to remove from
+        :param track_uris: list of track uris
+        :returns: json response of the last request, with the new snapshot_id
+        :rtype: dict
+
+        """
+        url = url_playlist_tracks(playlist_id)
+        j = None
+        for i in range(0, len(track_uris), MAX_TRACKS_PER_REQUEST):
+            chunk = track_uris[i:i + MAX_TRACKS_PER_REQUEST]
+            payload = {
+                "tracks": [{'uri': uri} for uri in chunk]
+            }
+            self._log('removing %d tracks from %s', len(chunk), url)
+            j = _parse(self._request('DELETE', url, json=payload))
+        return j
 
     def remove_track(self, playlist_id, track_uri):
-        payload = {
-            "tracks": [{'uri': track_uri}]
-        }
-        url = URLS['remove_track'].format(playlist_id=playlist_id)
-        self._log('removing {} from {}'.format(track_uri, url))
-        r = self.sess.delete(url, data=json.dumps(payload), headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self.remove_track(playlist_id, track_uri)
-        return r.json()
+        return self.remove_tracks(playlist_id, [track_uri])
+
+    def add_tracks(self, playlist_id, track_uris):
+        """appends tracks to a playlist in order, up to 100 per request
+
+        :param playlist_id: the playlist to add to
+        :param track_uris: list of track uris
+        :returns: json response of the last request, with the new snapshot_id
+        :rtype: dict
+
+        """
+        url = url_playlist_tracks(playlist_id)
+        j = None
+        for i in range(0, len(track_uris), MAX_TRACKS_PER_REQUEST):
+            chunk = track_uris[i:i + MAX_TRACKS_PER_REQUEST]
+            payload = {
+                "uris": chunk
+            }
+            self._log('adding %d tracks to %s', len(chunk), url)
+            j = _parse(self._request('POST', url, json=payload))
+        return j
 
     def add_track(self, playlist_id, track_uri):
-        payload = {
-            "uris": [track_uri]
-        }
-        url = URLS['add_track'].format(playlist_id=playlist_id)
-        self._log('adding {} to {}'.format(track_uri, url))
-        r = self.sess.post(url, params=payload, headers=self.auth_headers)
-        if self._rate_limit_check(r):
-            return self.add_track(playlist_id, track_uri)
-        return r.json()
-
-def put_file(content):
-    LOG.info('uploading')
-    utc_datetime = datetime.datetime.utcnow()
-    key_name = utc_datetime.strftime("%Y-%m-%d_%H%M%S_UTC.json.gz")
+        return self.add_tracks(playlist_id, [track_uri])
+
 
+def _bucket_name():
     stage = os.environ.get('STAGE', 'dev')
-    bucket_name = 'spotifyapi-' + stage
+    return 'spotifyapi-' + stage
+
+
+def compress(content):
+    """gzips bytes into an in memory file
+
+    :returns: file object holding the compressed bytes, at position 0
+    :rtype: io.BytesIO
+
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as gz:
+        gz.write(content)
+    buf.seek(0)
+    return buf
+
+
+def compress_json(data):
+    """serializes data to gzipped json
+
+    orjson produces the utf-8 bytes directly and they are streamed into the
+    gzip file, so no str or second uncompressed copy is ever built.
+
+    :returns: file object holding the compressed bytes, at position 0
+    :rtype: io.BytesIO
+
+    """
+    return compress(orjson.dumps(data))
+
+
+def put_file(fileobj, key_name=None):
+    """uploads gzipped json to the stage's bucket
+
+    Large files are uploaded in parts, several at a time.
 
-    LOG.info('uploading to {} : {}'.format(bucket_name, key_name))
+    :param fileobj: file object to read the gzipped json from
+    :param key_name: defaults to the current time, e.g.
+        2019-01-01_120000_UTC.json.gz
+    :returns: the key uploaded to
+    :rtype: str
+
+    """
+    LOG.info('uploading')
+    if key_name is None:
+        utc_datetime = datetime.datetime.utcnow()
+        key_name = utc_datetime.strftime("%Y-%m-%d_%H%M%S_UTC.json.gz")
+    bucket_name = _bucket_name()
+
+    LOG.info('uploading to %s : %s', bucket_name, key_name)
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    config = TransferConfig(multipart_threshold=UPLOAD_MULTIPART_THRESHOLD,
+                            max_concurrency=UPLOAD_MAX_CONCURRENCY)
+    extra_args = {'ContentType': 'application/json', 'ContentEncoding': 'gzip'}
+    boto3.client('s3').upload_fileobj(fileobj, bucket_name, key_name,
+                                      ExtraArgs=extra_args, Config=config)
+    return key_name
+
+
+def _get_object(key):
+    """reads an object from the stage's bucket
+
+    :returns: the object's content, None if it could not be read
+    :rtype: bytes
+
+    """
+    import boto3
+    from botocore.exceptions import ClientError
+    s3 = boto3.resource('s3')
+    try:
+        return s3.Object(_bucket_name(), key).get()['Body'].read()
+    except ClientError as e:
+        LOG.warning('could not load %s: %s', key, e)
+        return None
+
+
+def _put_object(key, body):
+    import boto3
     s3 = boto3.resource('s3')
-    object = s3.Object(bucket_name, key_name)
-    object.put(Body=content)
+    s3.Object(_bucket_name(), key).put(Body=body)
+
+
+def load_dump(key):
+    """loads a dump uploaded by pull
+
+    :returns: the dumped data, None if it could not be read
+    :rtype: dict
+
+    """
+    LOG.info('loading dump %s', key)
+    content = _get_object(key)
+    if content is None:
+        return None
+    return orjson.loads(gzip.decompress(content))
+
+
+def load_etags():
+    """loads the ETags saved by the previous pull
+
+    :returns: dict with 'dump', the key of the dump holding the bodies, and
+        'etags', a dict of url to ETag
+    :rtype: dict
+
+    """
+    content = _get_object(ETAGS_KEY)
+    if content is None:
+        return {'dump': None, 'etags': {}}
+    return orjson.loads(content)
+
+
+def save_etags(etags, dump_key):
+    LOG.info('saving %d etags', len(etags))
+    _put_object(ETAGS_KEY, orjson.dumps({'dump': dump_key, 'etags': etags}))
+
+
+def load_last_digest():
+    """loads the digest of the data uploaded by the previous pull
+
+    :returns: the hex digest, or None if there is none
+    :rtype: str
+
+    """
+    content = _get_object(LAST_DIGEST_KEY)
+    if content is None:
+        return None
+    return content.decode('utf-8').strip()
+
+
+def save_last_digest(digest):
+    _put_object(LAST_DIGEST_KEY, digest.encode('utf-8'))
 
 
 def general_setup():
@@ -247,29 +721,72 @@ def general_setup():
         logging.getLogger(l).setLevel(logging.WARN)
 
 def pull():
-    p = Puller()
-    data = {
-        'playlists': p.get_playlists(),
-        'recently_played': p.get_recently_played(),
-        'devices': p.get_devices(),
-        'top_artists_short': p.get_top('artists', 'short_term'),
-        'top_artists_medium': p.get_top('artists', 'medium_term'),
-        'top_artists_long': p.get_top('artists', 'long_term'),
-        'top_tracks_short': p.get_top('tracks', 'short_term'),
-        'top_tracks_medium': p.get_top('tracks', 'medium_term'),
-        'top_tracks_long': p.get_top('tracks', 'long_term'),
-        'followed_artists': p.get_followed_artists(),
-        'saved_albums': p.get_saved_albums(),
-        'saved_tracks': p.get_saved_tracks()
-    }
-    data_bytes = json.dumps(data).encode('utf-8')
-    compressed = gzip.compress(data_bytes)
-    put_file(compressed)
+    state = load_etags()
+    p = Puller(etags=state['etags'], last_dump=state['dump'])
+    with ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS) as pool:
+        futures = {
+            'playlists': pool.submit(p.get_playlists),
+            'recently_played': pool.submit(p.get_recently_played),
+            'devices': pool.submit(p.get_devices),
+            'top_artists_short': pool.submit(p.get_top, 'artists', 'short_term'),
+            'top_artists_medium': pool.submit(p.get_top, 'artists', 'medium_term'),
+            'top_artists_long': pool.submit(p.get_top, 'artists', 'long_term'),
+            'top_tracks_short': pool.submit(p.get_top, 'tracks', 'short_term'),
+            'top_tracks_medium': pool.submit(p.get_top, 'tracks', 'medium_term'),
+            'top_tracks_long': pool.submit(p.get_top, 'tracks', 'long_term'),
+            'followed_artists': pool.submit(p.get_followed_artists),
+            'saved_albums': pool.submit(p.get_saved_albums),
+            'saved_tracks': pool.submit(p.get_saved_tracks)
+        }
+        data = {key: f.result() for key, f in futures.items()}
+    data_bytes = orjson.dumps(data)
+    # hashing is far cheaper than compressing and uploading an identical dump
+    digest = hashlib.blake2b(data_bytes, digest_size=16).hexdigest()
+    if digest == load_last_digest():
+        LOG.info('nothing changed since the last pull, not uploading')
+        return
+    dump_key = put_file(compress(data_bytes))
+    save_etags(p.new_etags, dump_key)
+    save_last_digest(digest)
 
 
 def pull_handler(event, context):
     pull()
 
+_PULLER = None
+_PULLER_LOCK = threading.Lock()
+
+
+def get_puller():
+    """returns the Puller shared by the api handlers, creating it on first use
+
+    Reusing it keeps the access token, which is only refreshed once it expires
+    or is rejected, instead of fetching a new one on every request.
+
+    """
+    global _PULLER
+    with _PULLER_LOCK:
+        if _PULLER is None:
+            _PULLER = Puller()
+        return _PULLER
+
+
+@functools.lru_cache(maxsize=1)
+def _playlist_index(bucket):
+    """maps the lowercased names of the user's playlists to the playlists
+
+    :param bucket: only a cache key, pass the current time divided by
+        PLAYLIST_INDEX_TTL to refetch the playlists once per period
+    :returns: dict of name to simple playlist, the first of duplicate names wins
+    :rtype: dict
+
+    """
+    index = {}
+    for playlist in get_puller().get_playlists_short():
+        index.setdefault(playlist['name'].lower(), playlist)
+    return index
+
+
 def move_current_song(target_playlist, add=False):
     """if target_playlist is none then deletes it"""
     if target_playlist:
@@ -277,9 +794,9 @@ def move_current_song(target_playlist, add=False):
     def uri_to_id(uri):
         return uri.split(':')[-1]
 
-    p = Puller()
+    p = get_puller()
     r = p.get_current_track()
-    if r['item']:
+    if r and r['item']:
         track_name = r['item']['name']
         track = r['item']['uri']
     else:
@@ -289,23 +806,21 @@ def move_current_song(target_playlist, add=False):
 
     if not target_playlist:
         p.remove_track(source_id, track)
-        return "\"{}\" deleted from current playlist".format(track_name)
+        return f'"{track_name}" deleted from current playlist'
 
-    playlists = p.get_playlists_short()
-    target = [x for x in playlists if x['name'].lower() == target_playlist]
-    if len(target) == 1:
-        target = target[0]
-    else:
-        return "No such playlist '{}'".format(target_playlist)
+    target = _playlist_index(int(time.time() // PLAYLIST_INDEX_TTL)).get(
+        target_playlist)
+    if target is None:
+        return f"No such playlist '{target_playlist}'"
     target_uri = target['uri']
     target_name = target['name']
     target_id = uri_to_id(target_uri)
     p.add_track(target_id, track)
     if add:
-        return "\"{}\" added to \"{}\"".format(track_name, target_name)
+        return f'"{track_name}" added to "{target_name}"'
     else:
         p.remove_track(source_id, track)
-        return "\"{}\" moved to \"{}\"".format(track_name, target_name)
+        return f'"{track_name}" moved to "{target_name}"'
 
 app = Flask(__name__)
 CORS(app)
@@ -322,7 +837,8 @@ def handle_api(action):
         error = "Invalid api_key (no JSON body)"
         LOG.info(error)
         return error, 403
-    if j.get('api_key', None) != "FcZzT3FQgNDLkZVt9WvhPXdcf5sszE1N":
+    provided = str(j.get('api_key') or '').encode('utf-8')
+    if not hmac.compare_digest(hashlib.sha256(provided).digest(), API_KEY_HASH):
         error = "Invalid api_key"
         LOG.info(error)
         return error, 403